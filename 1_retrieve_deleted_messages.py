@@ -6,108 +6,56 @@ Outputs to JSON format for backup.
 """
 
 import asyncio
-import json
+import itertools
+import operator
 import os
+import time
 from datetime import datetime
 from pathlib import Path
-from dotenv import load_dotenv
-from telethon import TelegramClient
+from telethon.utils import get_peer_id
 from telethon.tl.functions.channels import GetAdminLogRequest
 from telethon.tl.types import (
-    ChannelAdminLogEventActionDeleteMessage,
+    ChannelAdminLogEventsFilter,
     InputChannel,
     Message
 )
+from tg_backup.common import (
+    CONCURRENCY,
+    OUTPUT_BUFFER_SIZE,
+    PHONE,
+    PROGRESS_INTERVAL,
+    check_credentials,
+    create_client,
+    download_media,
+    format_forward_info,
+    get_group_entity,
+    get_sender_details,
+    open_output_stream,
+    output_file_path,
+    resolve_sender,
+    write_json_footer,
+    write_json_header,
+    write_json_message,
+)
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Configuration
-API_ID = os.getenv('TELEGRAM_API_ID')  # Get from https://my.telegram.org
-API_HASH = os.getenv('TELEGRAM_API_HASH')  # Get from https://my.telegram.org
-PHONE = os.getenv('TELEGRAM_PHONE')  # Your phone number with country code
 SESSION_NAME = 'telegram_recovery_session'
 
 # Output configuration
 OUTPUT_DIR = Path('deleted_messages_backup')
-OUTPUT_FILE = OUTPUT_DIR / f'deleted_messages_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
+OUTPUT_FILE = output_file_path(OUTPUT_DIR, 'deleted_messages')
 MEDIA_DIR = OUTPUT_DIR / 'deleted_media'
 
+# Admin log pagination: 100 events is the maximum the API returns per request
+ADMIN_LOG_PAGE_SIZE = 100
 
-async def get_group_entity(client, group_identifier):
-    """
-    Get the group entity from username, invite link, or group ID.
-
-    Args:
-        client: TelegramClient instance
-        group_identifier: Group username (e.g., @groupname), invite link, or group ID
-
-    Returns:
-        Group entity
-    """
-    try:
-        # If it looks like a numeric ID, convert to int
-        if isinstance(group_identifier, str) and group_identifier.lstrip('-').isdigit():
-            group_identifier = int(group_identifier)
-            print(f"Converted to integer: {group_identifier}")
-
-        entity = await client.get_entity(group_identifier)
-        return entity
-    except ValueError as e:
-        # If get_entity fails, try searching through dialogs
-        print(f"Direct lookup failed, searching through your groups...")
-        target_id = int(group_identifier) if isinstance(group_identifier, str) and group_identifier.lstrip('-').isdigit() else None
-
-        async for dialog in client.iter_dialogs():
-            if dialog.is_group or dialog.is_channel:
-                if target_id and dialog.id == target_id:
-                    print(f"Found group in dialogs: {dialog.name}")
-                    return dialog.entity
-
-        print(f"Error getting group entity: {e}")
-        print("\nTroubleshooting tips:")
-        print("1. Make sure you're a member of the group")
-        print("2. Try using the group's @username instead of ID")
-        print("3. Run 'python3 list_groups.py' to see all your groups")
-        print("4. Try getting an invite link from the group and use that")
-        raise
-    except Exception as e:
-        print(f"Error getting group entity: {e}")
-        print("\nTroubleshooting tips:")
-        print("1. Make sure you're a member of the group")
-        print("2. Try using the group's @username instead of ID")
-        print("3. Run 'python3 list_groups.py' to see all your groups")
-        raise
-
-
-async def download_media(client, message, media_dir):
-    """
-    Download media from a message if it exists.
-
-    Args:
-        client: TelegramClient instance
-        message: Message object
-        media_dir: Directory to save media files
-
-    Returns:
-        Path to downloaded file or None
-    """
-    if not message.media:
-        return None
+# How many fetched events may be in flight ahead of the writer
+QUEUE_SIZE = 512
 
-    try:
-        # Create unique filename using message ID and date
-        file_path = await client.download_media(
-            message.media,
-            file=media_dir
-        )
-        return str(file_path) if file_path else None
-    except Exception as e:
-        print(f"Error downloading media for message {message.id}: {e}")
-        return None
+# Message fields read by extract_message_data, fetched in a single call
+_MESSAGE_FIELDS = operator.attrgetter('id', 'date', 'message', 'media', 'reply_to', 'forward')
 
 
-async def extract_message_data(client, message, media_dir, event_date):
+async def extract_message_data(client, message, media_dir, event_date, sender_cache, download_semaphore):
     """
     Extract relevant data from a message object.
 
@@ -116,45 +64,34 @@ async def extract_message_data(client, message, media_dir, event_date):
         message: Message object
         media_dir: Directory to save media files
         event_date: Date when the message was deleted
+        sender_cache: Dictionary of sender details already resolved, keyed by sender ID
+        download_semaphore: asyncio.Semaphore limiting concurrent media downloads
 
     Returns:
-        Dictionary with message data
+        Dictionary with message data (dates are left as datetime objects,
+        which orjson writes in ISO 8601 format)
     """
+    message_id, date, text, media, reply_to, forward = _MESSAGE_FIELDS(message)
+
     media_path = None
-    if message.media:
-        media_path = await download_media(client, message, media_dir)
-
-    # Get sender information
-    sender_name = "Unknown"
-    sender_id = None
-    sender_username = None
-    if message.sender:
-        sender_id = message.sender.id
-        if hasattr(message.sender, 'username') and message.sender.username:
-            sender_username = message.sender.username
-        if hasattr(message.sender, 'first_name'):
-            sender_name = message.sender.first_name
-            if hasattr(message.sender, 'last_name') and message.sender.last_name:
-                sender_name += f" {message.sender.last_name}"
-        elif hasattr(message.sender, 'title'):
-            sender_name = message.sender.title
+    if media:
+        media_path = await download_media(client, message, media_dir, download_semaphore)
+
+    # Get sender information (resolved once per sender, then cached)
+    sender_id, sender_name, sender_username = resolve_sender(message, sender_cache)
 
     return {
-        'message_id': message.id,
-        'date': message.date.isoformat() if message.date else None,
-        'deleted_date': event_date.isoformat() if event_date else None,
+        'message_id': message_id,
+        'date': date,
+        'deleted_date': event_date,
         'sender_id': sender_id,
         'sender_name': sender_name,
         'sender_username': sender_username,
-        'text': message.message or "",
-        'media_type': message.media.__class__.__name__ if message.media else None,
+        'text': text or "",
+        'media_type': media.__class__.__name__ if media else None,
         'media_path': media_path,
-        'reply_to_msg_id': message.reply_to.reply_to_msg_id if message.reply_to else None,
-        'forward_info': {
-            'from_id': message.forward.from_id.user_id if message.forward and hasattr(message.forward.from_id, 'user_id') else None,
-            'from_name': message.forward.from_name if message.forward else None,
-            'date': message.forward.date.isoformat() if message.forward and message.forward.date else None
-        } if message.forward else None
+        'reply_to_msg_id': reply_to.reply_to_msg_id if reply_to else None,
+        'forward_info': format_forward_info(forward)
     }
 
 
@@ -166,12 +103,7 @@ async def retrieve_deleted_messages(group_identifier):
         group_identifier: Group username, invite link, or group ID
     """
     # Validate configuration
-    if not API_ID or not API_HASH or not PHONE:
-        print("ERROR: Please set the following environment variables:")
-        print("  - TELEGRAM_API_ID")
-        print("  - TELEGRAM_API_HASH")
-        print("  - TELEGRAM_PHONE")
-        print("\nYou can get API_ID and API_HASH from https://my.telegram.org")
+    if not check_credentials():
         return
 
     # Create output directories
@@ -179,7 +111,7 @@ async def retrieve_deleted_messages(group_identifier):
     MEDIA_DIR.mkdir(exist_ok=True)
 
     # Initialize Telegram client
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    client = create_client(SESSION_NAME)
 
     try:
         await client.start(phone=PHONE)
@@ -210,68 +142,112 @@ async def retrieve_deleted_messages(group_identifier):
 
         # Retrieve admin log events
         print("\nRetrieving admin log (deleted messages)...")
-        deleted_messages = []
-
-        # Paginate through all admin log events
-        max_id = 0
+        sender_cache = {}
+        download_semaphore = asyncio.Semaphore(CONCURRENCY)
+        deleted_count = 0
+        media_count = 0
+        last_progress = 0.0
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
         total_events_fetched = 0
-        processed = 0
-
-        while True:
-            # Get admin log with filter for deleted messages
-            admin_log = await client(GetAdminLogRequest(
-                channel=group,
-                q='',  # No search query
-                max_id=max_id,
-                min_id=0,
-                limit=100,  # Retrieve up to 100 events at a time
-            ))
-
-            if not admin_log.events:
-                break  # No more events to fetch
-
-            total_events_fetched += len(admin_log.events)
-            print(f"Fetched {total_events_fetched} admin log events...", end='\r')
-
-            for event in admin_log.events:
-                # Filter for message deletion events
-                if isinstance(event.action, ChannelAdminLogEventActionDeleteMessage):
-                    processed += 1
-                    print(f"Processing deleted message {processed}...", end='\r')
-
-                    message = event.action.message
-                    if isinstance(message, Message):
-                        message_data = await extract_message_data(
-                            client,
-                            message,
-                            MEDIA_DIR,
-                            event.date
-                        )
-                        message_data['deleted_by_user_id'] = event.user_id
-                        deleted_messages.append(message_data)
-
-            # Get the last event's ID for pagination
-            max_id = admin_log.events[-1].id
-
-        print(f"\nFound {len(deleted_messages)} deleted messages from {total_events_fetched} total admin log events")
-
-        # Save to JSON file
-        output_data = {
-            'group_id': group.id,
-            'group_title': group.title,
-            'retrieved_at': datetime.now().isoformat(),
-            'total_deleted_messages': len(deleted_messages),
-            'messages': deleted_messages
-        }
-
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
+
+        async def fetch_events():
+            """Paginate through the admin log deletion events and start extracting them."""
+            nonlocal total_events_fetched
+            max_id = 0
+
+            try:
+                while True:
+                    # Get admin log with filter for deleted messages
+                    admin_log = await client(GetAdminLogRequest(
+                        channel=group,
+                        q='',  # No search query
+                        max_id=max_id,
+                        min_id=0,
+                        limit=ADMIN_LOG_PAGE_SIZE,
+                        events_filter=ChannelAdminLogEventsFilter(delete=True),
+                    ))
+
+                    if not admin_log.events:
+                        break  # No more events to fetch
+
+                    total_events_fetched += len(admin_log.events)
+                    print(f"Fetched {total_events_fetched} deletion events...", end='\r')
+
+                    # Messages in the admin log come without their sender attached;
+                    # each page includes the users and chats it refers to instead
+                    for entity in itertools.chain(admin_log.users, admin_log.chats):
+                        peer_id = get_peer_id(entity)
+                        if peer_id not in sender_cache:
+                            sender_cache[peer_id] = get_sender_details(entity)
+
+                    # The server only returns message deletion events
+                    for event in admin_log.events:
+                        message = event.action.message
+                        if isinstance(message, Message):
+                            task = asyncio.create_task(extract_message_data(
+                                client,
+                                message,
+                                MEDIA_DIR,
+                                event.date,
+                                sender_cache,
+                                download_semaphore
+                            ))
+                            await queue.put((message.id, event.user_id, task))
+
+                    # Get the last event's ID for pagination
+                    max_id = admin_log.events[-1].id
+            finally:
+                await queue.put(None)
+
+        # Write to a partial file first so an interrupted run never
+        # leaves a truncated file behind under the final name
+        partial_file = OUTPUT_FILE.with_name(f'{OUTPUT_FILE.name}.partial')
+        producer = asyncio.create_task(fetch_events())
+        try:
+            with open(partial_file, 'wb', buffering=OUTPUT_BUFFER_SIZE) as raw, open_output_stream(raw) as f:
+                write_json_header(f, {
+                    'group_id': group.id,
+                    'group_title': group.title,
+                    'retrieved_at': datetime.now().isoformat(),
+                })
+
+                # Writer: consume extraction tasks in admin log order, so
+                # downloads run concurrently while the output order is kept
+                while (item := await queue.get()) is not None:
+                    message_id, deleted_by_user_id, task = item
+                    try:
+                        message_data = await task
+                    except Exception as e:
+                        print(f"\nError processing deleted message {message_id}: {e}")
+                        continue
+
+                    message_data['deleted_by_user_id'] = deleted_by_user_id
+                    write_json_message(f, message_data, first=deleted_count == 0)
+                    deleted_count += 1
+                    media_count += bool(message_data['media_path'])
+                    now = time.monotonic()
+                    if now - last_progress >= PROGRESS_INTERVAL:
+                        print(f"Processing deleted message {deleted_count}...", end='\r')
+                        last_progress = now
+
+                await producer
+                write_json_footer(f, {'total_deleted_messages': deleted_count})
+
+            os.replace(partial_file, OUTPUT_FILE)
+        finally:
+            producer.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[2].cancel()
+
+        print(f"\nFound {deleted_count} deleted messages from {total_events_fetched} deletion events")
 
         print(f"\n✓ Deleted messages saved to: {OUTPUT_FILE}")
         print(f"✓ Media files saved to: {MEDIA_DIR}")
         print(f"\nSummary:")
-        print(f"  - Total deleted messages: {len(deleted_messages)}")
-        print(f"  - Messages with media: {sum(1 for m in deleted_messages if m['media_path'])}")
+        print(f"  - Total deleted messages: {deleted_count}")
+        print(f"  - Messages with media: {media_count}")
 
     except Exception as e:
         print(f"\n✗ Error: {e}")
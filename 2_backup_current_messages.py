@@ -6,106 +6,52 @@ Downloads all media files associated with messages.
 """
 
 import asyncio
-import json
+import operator
 import os
+import time
 from datetime import datetime
 from pathlib import Path
-from dotenv import load_dotenv
-from telethon import TelegramClient
 from telethon.tl.types import Message
+from tg_backup.common import (
+    CONCURRENCY,
+    OUTPUT_BUFFER_SIZE,
+    PHONE,
+    PROGRESS_INTERVAL,
+    check_credentials,
+    create_client,
+    download_media,
+    format_forward_info,
+    get_group_entity,
+    open_media_cache,
+    open_output_stream,
+    output_file_path,
+    resolve_sender,
+    write_json_footer,
+    write_json_header,
+    write_json_message,
+)
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Configuration
-API_ID = os.getenv('TELEGRAM_API_ID')  # Get from https://my.telegram.org
-API_HASH = os.getenv('TELEGRAM_API_HASH')  # Get from https://my.telegram.org
-PHONE = os.getenv('TELEGRAM_PHONE')  # Your phone number with country code
 SESSION_NAME = 'telegram_backup_session'
 
 # Output configuration
 OUTPUT_DIR = Path('current_messages_backup')
-OUTPUT_FILE = OUTPUT_DIR / f'current_messages_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
+OUTPUT_FILE = output_file_path(OUTPUT_DIR, 'current_messages')
 MEDIA_DIR = OUTPUT_DIR / 'current_media'
+MEDIA_CACHE_FILE = OUTPUT_DIR / 'media_cache.db'  # Media already downloaded by earlier runs
 
 # Batch size for saving progress
 SAVE_BATCH_SIZE = 100
 
+# How many fetched messages may be in flight ahead of the writer
+QUEUE_SIZE = 64
 
-async def get_group_entity(client, group_identifier):
-    """
-    Get the group entity from username, invite link, or group ID.
+# Message fields read by extract_message_data, fetched in a single call
+_MESSAGE_FIELDS = operator.attrgetter(
+    'id', 'date', 'edit_date', 'message', 'media', 'reply_to', 'forward', 'reactions', 'views', 'pinned'
+)
 
-    Args:
-        client: TelegramClient instance
-        group_identifier: Group username (e.g., @groupname), invite link, or group ID
 
-    Returns:
-        Group entity
-    """
-    try:
-        # If it looks like a numeric ID, convert to int
-        if isinstance(group_identifier, str) and group_identifier.lstrip('-').isdigit():
-            group_identifier = int(group_identifier)
-            print(f"Converted to integer: {group_identifier}")
-
-        entity = await client.get_entity(group_identifier)
-        return entity
-    except ValueError as e:
-        # If get_entity fails, try searching through dialogs
-        print(f"Direct lookup failed, searching through your groups...")
-        target_id = int(group_identifier) if isinstance(group_identifier, str) and group_identifier.lstrip('-').isdigit() else None
-
-        async for dialog in client.iter_dialogs():
-            if dialog.is_group or dialog.is_channel:
-                if target_id and dialog.id == target_id:
-                    print(f"Found group in dialogs: {dialog.name}")
-                    return dialog.entity
-
-        print(f"Error getting group entity: {e}")
-        print("\nTroubleshooting tips:")
-        print("1. Make sure you're a member of the group")
-        print("2. Try using the group's @username instead of ID")
-        print("3. Run 'python3 list_groups.py' to see all your groups")
-        print("4. Try getting an invite link from the group and use that")
-        raise
-    except Exception as e:
-        print(f"Error getting group entity: {e}")
-        print("\nTroubleshooting tips:")
-        print("1. Make sure you're a member of the group")
-        print("2. Try using the group's @username instead of ID")
-        print("3. Run 'python3 list_groups.py' to see all your groups")
-        raise
-
-
-async def download_media(client, message, media_dir):
-    """
-    Download media from a message if it exists.
-
-    Args:
-        client: TelegramClient instance
-        message: Message object
-        media_dir: Directory to save media files
-
-    Returns:
-        Path to downloaded file or None
-    """
-    if not message.media:
-        return None
-
-    try:
-        # Create unique filename using message ID
-        file_path = await client.download_media(
-            message.media,
-            file=media_dir
-        )
-        return str(file_path) if file_path else None
-    except Exception as e:
-        print(f"Error downloading media for message {message.id}: {e}")
-        return None
-
-
-async def extract_message_data(client, message, media_dir):
+async def extract_message_data(client, message, media_dir, sender_cache, download_semaphore, media_cache=None):
     """
     Extract relevant data from a message object.
 
@@ -113,60 +59,48 @@ async def extract_message_data(client, message, media_dir):
         client: TelegramClient instance
         message: Message object
         media_dir: Directory to save media files
+        sender_cache: Dictionary of sender details already resolved, keyed by sender ID
+        download_semaphore: asyncio.Semaphore limiting concurrent media downloads
+        media_cache: Optional sqlite3.Connection from open_media_cache
 
     Returns:
-        Dictionary with message data
+        Dictionary with message data (dates are left as datetime objects,
+        which orjson writes in ISO 8601 format)
     """
+    (message_id, date, edit_date, text, media, reply_to, forward,
+     message_reactions, views, pinned) = _MESSAGE_FIELDS(message)
+
     media_path = None
-    if message.media:
-        media_path = await download_media(client, message, media_dir)
-
-    # Get sender information
-    sender_name = "Unknown"
-    sender_id = None
-    sender_username = None
-    if message.sender:
-        sender_id = message.sender.id
-        if hasattr(message.sender, 'username') and message.sender.username:
-            sender_username = message.sender.username
-        if hasattr(message.sender, 'first_name'):
-            sender_name = message.sender.first_name
-            if hasattr(message.sender, 'last_name') and message.sender.last_name:
-                sender_name += f" {message.sender.last_name}"
-        elif hasattr(message.sender, 'title'):
-            sender_name = message.sender.title
-
-    # Get edit date if message was edited
-    edit_date = message.edit_date.isoformat() if message.edit_date else None
+    if media:
+        media_path = await download_media(client, message, media_dir, download_semaphore, media_cache)
+
+    # Get sender information (resolved once per sender, then cached)
+    sender_id, sender_name, sender_username = resolve_sender(message, sender_cache)
 
     # Get reactions if any
     reactions = []
-    if message.reactions:
-        for reaction_count in message.reactions.results:
+    if message_reactions:
+        for reaction_count in message_reactions.results:
             reactions.append({
-                'emoticon': reaction_count.reaction.emoticon if hasattr(reaction_count.reaction, 'emoticon') else None,
+                'emoticon': getattr(reaction_count.reaction, 'emoticon', None),
                 'count': reaction_count.count
             })
 
     return {
-        'message_id': message.id,
-        'date': message.date.isoformat() if message.date else None,
+        'message_id': message_id,
+        'date': date,
         'edit_date': edit_date,
         'sender_id': sender_id,
         'sender_name': sender_name,
         'sender_username': sender_username,
-        'text': message.message or "",
-        'media_type': message.media.__class__.__name__ if message.media else None,
+        'text': text or "",
+        'media_type': media.__class__.__name__ if media else None,
         'media_path': media_path,
-        'reply_to_msg_id': message.reply_to.reply_to_msg_id if message.reply_to else None,
-        'forward_info': {
-            'from_id': message.forward.from_id.user_id if message.forward and hasattr(message.forward.from_id, 'user_id') else None,
-            'from_name': message.forward.from_name if message.forward else None,
-            'date': message.forward.date.isoformat() if message.forward and message.forward.date else None
-        } if message.forward else None,
+        'reply_to_msg_id': reply_to.reply_to_msg_id if reply_to else None,
+        'forward_info': format_forward_info(forward),
         'reactions': reactions if reactions else None,
-        'views': message.views if hasattr(message, 'views') else None,
-        'pinned': message.pinned if hasattr(message, 'pinned') else False
+        'views': views,
+        'pinned': pinned
     }
 
 
@@ -179,12 +113,7 @@ async def backup_current_messages(group_identifier, limit=None):
         limit: Maximum number of messages to retrieve (None for all)
     """
     # Validate configuration
-    if not API_ID or not API_HASH or not PHONE:
-        print("ERROR: Please set the following environment variables:")
-        print("  - TELEGRAM_API_ID")
-        print("  - TELEGRAM_API_HASH")
-        print("  - TELEGRAM_PHONE")
-        print("\nYou can get API_ID and API_HASH from https://my.telegram.org")
+    if not check_credentials():
         return
 
     # Create output directories
@@ -192,7 +121,7 @@ async def backup_current_messages(group_identifier, limit=None):
     MEDIA_DIR.mkdir(exist_ok=True)
 
     # Initialize Telegram client
-    client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    client = create_client(SESSION_NAME)
 
     try:
         await client.start(phone=PHONE)
@@ -207,44 +136,97 @@ async def backup_current_messages(group_identifier, limit=None):
         print("\nRetrieving messages from the group...")
         print("This may take a while depending on the number of messages...")
 
-        all_messages = []
+        # iter_messages(reverse=True) yields oldest first, so messages can be
+        # written as they arrive. With a limit, start from the oldest of the
+        # newest `limit` messages.
+        min_id = 0
+        if limit:
+            boundary = await client.get_messages(group, limit=1, add_offset=limit - 1)
+            if boundary:
+                min_id = boundary[0].id - 1
+
+        media_cache = open_media_cache(MEDIA_CACHE_FILE)
+        sender_cache = {}
+        download_semaphore = asyncio.Semaphore(CONCURRENCY)
         message_count = 0
-
-        async for message in client.iter_messages(group, limit=limit):
-            if isinstance(message, Message):
-                message_count += 1
-                print(f"Processing message {message_count} (ID: {message.id})...", end='\r')
-
-                message_data = await extract_message_data(client, message, MEDIA_DIR)
-                all_messages.append(message_data)
-
-                # Save progress in batches
-                if message_count % SAVE_BATCH_SIZE == 0:
-                    print(f"\nSaved progress: {message_count} messages processed")
-
-        print(f"\n\nTotal messages retrieved: {len(all_messages)}")
-
-        # Sort messages by date (oldest first)
-        all_messages.sort(key=lambda x: x['date'] if x['date'] else '')
-
-        # Save to JSON file
-        output_data = {
-            'group_id': group.id,
-            'group_title': group.title,
-            'backed_up_at': datetime.now().isoformat(),
-            'total_messages': len(all_messages),
-            'messages': all_messages
-        }
-
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=2, ensure_ascii=False)
+        stats = {'media': 0, 'text': 0, 'reactions': 0}
+        last_progress = 0.0
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+        async def produce():
+            """Start extraction for each message, in order, as it is fetched."""
+            try:
+                async for message in client.iter_messages(group, min_id=min_id, reverse=True):
+                    if isinstance(message, Message):
+                        task = asyncio.create_task(
+                            extract_message_data(client, message, MEDIA_DIR, sender_cache, download_semaphore, media_cache)
+                        )
+                        await queue.put((message.id, task))
+            finally:
+                await queue.put(None)
+
+        # Write to a partial file first so an interrupted backup never
+        # leaves a truncated file behind under the final name
+        partial_file = OUTPUT_FILE.with_name(f'{OUTPUT_FILE.name}.partial')
+        producer = asyncio.create_task(produce())
+        try:
+            with open(partial_file, 'wb', buffering=OUTPUT_BUFFER_SIZE) as raw, open_output_stream(raw) as f:
+                write_json_header(f, {
+                    'group_id': group.id,
+                    'group_title': group.title,
+                    'backed_up_at': datetime.now().isoformat(),
+                })
+
+                # Writer: consume extraction tasks in order, so downloads run
+                # concurrently while the output stays sorted by date
+                while (item := await queue.get()) is not None:
+                    message_id, task = item
+                    try:
+                        message_data = await task
+                    except Exception as e:
+                        print(f"\nError processing message {message_id}: {e}")
+                        continue
+
+                    write_json_message(f, message_data, first=message_count == 0)
+                    message_count += 1
+                    stats['media'] += bool(message_data['media_path'])
+                    stats['text'] += bool(message_data['text'])
+                    stats['reactions'] += bool(message_data['reactions'])
+                    now = time.monotonic()
+                    if now - last_progress >= PROGRESS_INTERVAL:
+                        print(f"Processing message {message_count} (ID: {message_id})...", end='\r')
+                        last_progress = now
+
+                    # Save progress in batches
+                    if message_count % SAVE_BATCH_SIZE == 0:
+                        # Flush on a worker thread so downloads keep running meanwhile;
+                        # this coroutine is the only writer, so f is not touched concurrently
+                        await asyncio.to_thread(f.flush)
+                        media_cache.commit()
+                        print(f"\nSaved progress: {message_count} messages processed")
+
+                await producer
+                write_json_footer(f, {'total_messages': message_count})
+
+            os.replace(partial_file, OUTPUT_FILE)
+        finally:
+            producer.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+            media_cache.commit()
+            media_cache.close()
+
+        print(f"\n\nTotal messages retrieved: {message_count}")
 
         print(f"\n✓ Messages saved to: {OUTPUT_FILE}")
         print(f"✓ Media files saved to: {MEDIA_DIR}")
         print(f"\nSummary:")
-        print(f"  - Total messages: {len(all_messages)}")
-        print(f"  - Messages with media: {sum(1 for m in all_messages if m['media_path'])}")
-        print(f"  - Messages with text: {sum(1 for m in all_messages if m['text'])}")
+        print(f"  - Total messages: {message_count}")
+        print(f"  - Messages with media: {stats['media']}")
+        print(f"  - Messages with text: {stats['text']}")
+        print(f"  - Messages with reactions: {stats['reactions']}")
 
     except Exception as e:
         print(f"\n✗ Error: {e}")
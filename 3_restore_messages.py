@@ -6,19 +6,39 @@ Messages are sent with timestamp prefix and author name.
 """
 
 import asyncio
+import collections
+import functools
 import json
 import os
 import hashlib
+import heapq
+import io
+import itertools
+import mmap
+import operator
+import sqlite3
 import tempfile
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+import ijson
+import orjson
+import zstandard
 from dotenv import load_dotenv
 from telethon import TelegramClient
-from telethon.tl.types import InputMediaUploadedDocument, DocumentAttributeFilename
+from telethon.tl.types import InputMediaUploadedDocument, DocumentAttributeFilename, InputFileBig
+from telethon.tl.functions.upload import SaveBigFilePartRequest
 from telethon.errors import FloodWaitError, SlowModeWaitError
+from telethon.helpers import generate_random_long
+from telethon.sessions import SQLiteSession
+from telethon.utils import get_attributes, get_peer_id
 import time
 
+try:
+    import uvloop  # Faster event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -26,27 +46,110 @@ load_dotenv()
 API_ID = os.getenv('TELEGRAM_API_ID')  # Get from https://my.telegram.org
 API_HASH = os.getenv('TELEGRAM_API_HASH')  # Get from https://my.telegram.org
 PHONE = os.getenv('TELEGRAM_PHONE')  # Your phone number with country code
-SESSION_NAME = 'sessions/telegram_restore_session'
-
-# Rate limiting configuration: 15 requests per minute = 1 request every 4 seconds
-MESSAGE_DELAY = 4.0  # Delay between messages (seconds) - 15 req/min
-MEDIA_DELAY = 4.0  # Delay for messages with media (seconds) - 15 req/min
+SESSION_NAME = os.getenv('SESSION_NAME', 'sessions/telegram_restore_session')  # Telethon session file path
+TARGET_CACHE_FILE = Path(SESSION_NAME).parent / 'restore_targets.json'  # Target groups found by earlier runs
+
+# Rate limiting configuration: at most 15 messages in any 60-second window
+RATE_LIMIT_MESSAGES = 15  # Messages allowed per window - 15 req/min
+RATE_LIMIT_PERIOD = 60.0  # Length of the window (seconds)
+
+# Separator line between the header and the text of restored messages
+MESSAGE_SEPARATOR = "-" * 50
+
+# Coalescing: optionally send consecutive text messages from the same sender,
+# written within COALESCE_WINDOW seconds, as a single Telegram message, and
+# consecutive photos as a single album
+COALESCE_MESSAGES = os.getenv('COALESCE_MESSAGES', 'no').lower() in ('yes', 'true', '1')
+COALESCE_WINDOW = 60.0  # Seconds after the first message of a group
+MAX_MESSAGE_LENGTH = 4000  # Stay under Telegram's 4096 character limit
+MAX_ALBUM_SIZE = 10  # Telegram's limit of media per album
+
+# Pipeline configuration: how many formatted messages may wait ahead of the sender,
+# and how many are prepared per worker thread call
+SEND_QUEUE_SIZE = 32
+PREPARE_BATCH_SIZE = 16
+UPLOAD_CONCURRENCY = 3  # Media files uploaded at once ahead of the sender
+PARALLEL_UPLOAD_MIN_SIZE = 10 * 1024 * 1024  # Files from this size up have their parts sent in parallel
+UPLOAD_PART_SIZE = 512 * 1024  # Largest part size Telegram accepts
+UPLOAD_PART_WORKERS = 8  # Parts of one file in flight at once
+PROGRESS_INTERVAL = 0.5  # Minimum seconds between progress updates
 
 # Checkpoint configuration
 CHECKPOINT_FILE = Path(__file__).parent / '.restore_checkpoint.json'
 CHECKPOINT_VERSION = 1
 CHECKPOINT_MODE = os.getenv('CHECKPOINT_MODE', 'prompt')  # 'prompt', 'resume', 'restart'
+# Rehash every source file when resuming, instead of trusting unchanged size/mtime/inode
+CHECKPOINT_STRICT = os.getenv('CHECKPOINT_STRICT', 'no').lower() in ('yes', 'true', '1')
+HASH_CACHE_FILE = Path(__file__).parent / '.restore_hashes.json'  # Source file hashes by size, mtime and inode
+HASH_CHUNK_SIZE = 1 << 20  # Read source files 1 MiB at a time when hashing
+HASH_WORKERS = 8  # Source files hashed at once
+CHECKPOINT_INTERVAL_MSGS = 10  # Save the checkpoint every N messages...
+CHECKPOINT_INTERVAL_SECS = 5.0  # ...or when the last save is older than this
 
 
 def compute_file_hash(filepath: Path) -> str:
     """Compute SHA256 hash of a file for integrity checking."""
-    sha256 = hashlib.sha256()
     with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            sha256.update(chunk)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+, reads and hashes in C
+            sha256 = hashlib.file_digest(f, 'sha256')
+        else:
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha256.update(chunk)
     return f"sha256:{sha256.hexdigest()}"
 
 
+def compute_file_hashes(filepaths: list, use_cache: bool = True) -> dict:
+    """
+    Compute SHA256 hashes of several files for integrity checking.
+
+    Hashes are remembered in HASH_CACHE_FILE with the file's size,
+    modification time and inode, so an unchanged file is only read once
+    (unless use_cache is False). Files that have to be read are hashed
+    on several threads, since hashlib releases the GIL while hashing.
+
+    Returns:
+        Dict mapping each of the given paths to its hash
+    """
+    try:
+        cache = orjson.loads(HASH_CACHE_FILE.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        cache = {}
+
+    hashes = {}
+    to_hash = {}
+    for filepath in filepaths:
+        stat = Path(filepath).stat()
+        key = str(Path(filepath).resolve())
+        cached = cache.get(key) if use_cache else None
+        if (cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns
+                and cached.get('inode') == stat.st_ino):
+            hashes[filepath] = cached['hash']
+        else:
+            to_hash[filepath] = (key, stat)
+    if not to_hash:
+        return hashes
+
+    with ThreadPoolExecutor(max_workers=min(HASH_WORKERS, len(to_hash))) as executor:
+        for filepath, file_hash in zip(to_hash, executor.map(compute_file_hash, map(Path, to_hash))):
+            key, stat = to_hash[filepath]
+            hashes[filepath] = file_hash
+            cache[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino, 'hash': file_hash}
+    try:
+        HASH_CACHE_FILE.write_bytes(orjson.dumps(cache))
+    except OSError as e:
+        print(f"Warning: Could not save file hash cache: {e}")
+    return hashes
+
+
+def file_stat_identity(filepath: Path) -> dict:
+    """Size, modification time and inode of a file, which change when it is rewritten."""
+    stat = filepath.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+
 def compute_operation_hash(backup_files: list, target_group_id: int, merge: bool) -> str:
     """Compute a unique hash identifying this restore operation."""
     data = {
@@ -54,6 +157,7 @@ def compute_operation_hash(backup_files: list, target_group_id: int, merge: bool
         'target': target_group_id,
         'merge': merge
     }
+    # Kept on the json module: its output (and so the hash of existing checkpoints) must not change
     content = json.dumps(data, sort_keys=True)
     return f"sha256:{hashlib.sha256(content.encode()).hexdigest()}"
 
@@ -63,13 +167,12 @@ def load_checkpoint() -> dict | None:
     if not CHECKPOINT_FILE.exists():
         return None
     try:
-        with open(CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
-            checkpoint = json.load(f)
+        checkpoint = orjson.loads(CHECKPOINT_FILE.read_bytes())
         if checkpoint.get('version') != CHECKPOINT_VERSION:
             print(f"Warning: Checkpoint version mismatch (found v{checkpoint.get('version')}, expected v{CHECKPOINT_VERSION})")
             return None
         return checkpoint
-    except (json.JSONDecodeError, IOError) as e:
+    except (orjson.JSONDecodeError, IOError) as e:
         print(f"Warning: Could not read checkpoint: {e}")
         return None
 
@@ -84,9 +187,12 @@ def save_checkpoint(checkpoint: dict) -> None:
         dir=CHECKPOINT_FILE.parent
     )
     try:
-        with os.fdopen(temp_fd, 'w', encoding='utf-8') as f:
-            json.dump(checkpoint, f, indent=2)
-        shutil.move(temp_path, CHECKPOINT_FILE)
+        with os.fdopen(temp_fd, 'wb') as f:
+            f.write(orjson.dumps(checkpoint, option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        # Same directory, so this is an atomic rename
+        os.replace(temp_path, CHECKPOINT_FILE)
     except Exception:
         if Path(temp_path).exists():
             os.unlink(temp_path)
@@ -100,20 +206,37 @@ def clear_checkpoint() -> None:
         print("Checkpoint cleared.")
 
 
-def validate_checkpoint(checkpoint: dict, backup_files: list, target_group_id: int, merge: bool) -> tuple[bool, str]:
+def validate_checkpoint(
+    checkpoint: dict,
+    backup_files: list,
+    target_group_id: int,
+    merge: bool,
+    strict: bool = False
+) -> tuple[bool, str]:
     """
     Validate if checkpoint matches current operation.
+    With strict, every source file is read and hashed again.
     Returns (is_valid, reason_if_invalid).
     """
     current_hash = compute_operation_hash(backup_files, target_group_id, merge)
     if checkpoint.get('operation_hash') != current_hash:
         return False, "Operation parameters differ (different files, target, or merge setting)"
 
-    for filepath, expected_hash in checkpoint.get('source_files_hashes', {}).items():
+    source_files_stat = checkpoint.get('source_files_stat', {})
+    source_files_hashes = checkpoint.get('source_files_hashes', {})
+    to_hash = []
+    for filepath in source_files_hashes:
         if not Path(filepath).exists():
             return False, f"Source file no longer exists: {filepath}"
-        actual_hash = compute_file_hash(Path(filepath))
-        if actual_hash != expected_hash:
+        # An unchanged size, mtime and inode show the file wasn't touched,
+        # so it only has to be hashed again if one of them differs
+        if strict or source_files_stat.get(filepath) != file_stat_identity(Path(filepath)):
+            to_hash.append(filepath)
+
+    # Files are only rehashed when their identity changed, so the hash cache
+    # (keyed on that same identity) can't vouch for them
+    for filepath, actual_hash in compute_file_hashes(to_hash, use_cache=False).items():
+        if actual_hash != source_files_hashes[filepath]:
             return False, f"Source file was modified: {filepath}"
 
     return True, ""
@@ -128,7 +251,8 @@ def create_checkpoint(
 ) -> dict:
     """Create a new checkpoint for this restore operation."""
     resolved_files = [str(Path(f).resolve()) for f in backup_files]
-    file_hashes = {f: compute_file_hash(Path(f)) for f in resolved_files}
+    file_hashes = compute_file_hashes(resolved_files)
+    file_stats = {f: file_stat_identity(Path(f)) for f in resolved_files}
 
     return {
         'version': CHECKPOINT_VERSION,
@@ -139,6 +263,7 @@ def create_checkpoint(
         'target_group_title': target_group_title,
         'source_files': resolved_files,
         'source_files_hashes': file_hashes,
+        'source_files_stat': file_stats,
         'merge_enabled': merge,
         'total_messages': total_messages,
         'last_successful_index': -1,
@@ -168,7 +293,7 @@ def prompt_resume_or_restart(checkpoint: dict) -> str:
     print(f"Time spent: {int(elapsed / 60)}m {int(elapsed % 60)}s")
 
     remaining = checkpoint['total_messages'] - (checkpoint['last_successful_index'] + 1)
-    est_remaining = remaining * MESSAGE_DELAY
+    est_remaining = remaining * RATE_LIMIT_PERIOD / RATE_LIMIT_MESSAGES
     print(f"Estimated time remaining: {int(est_remaining / 3600)}h {int((est_remaining % 3600) / 60)}m")
 
     print("\nOptions:")
@@ -191,6 +316,29 @@ def prompt_resume_or_restart(checkpoint: dict) -> str:
             print("Invalid choice. Please enter 'r', 's', or 'c'.")
 
 
+def enable_session_wal(client):
+    """
+    Put the session database in WAL mode with relaxed syncing.
+
+    Telethon writes to its session file all through a restore; with a
+    write-ahead log each of those commits is a cheap append instead of a
+    rewritten journal and several fsyncs.
+
+    Args:
+        client: TelegramClient instance (not yet started)
+    """
+    if not isinstance(client.session, SQLiteSession):
+        return
+    try:
+        cursor = client.session._cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+    except sqlite3.Error as e:
+        # Some file systems (e.g. network or Docker Desktop mounts) don't support WAL
+        print(f"Warning: Could not enable WAL mode for the session file: {e}")
+
+
 async def get_group_entity(client, group_identifier):
     """
     Get the group entity from username, invite link, or group ID.
@@ -237,9 +385,229 @@ async def get_group_entity(client, group_identifier):
         raise
 
 
+def open_backup_file(backup_path):
+    """
+    Open a backup file for reading, decompressing it if needed.
+
+    Args:
+        backup_path: Path to a .json backup, or an .ndjson backup with one
+            message per line after a header record, optionally compressed
+            with zstd (.json.zst / .ndjson.zst)
+
+    Returns:
+        Tuple of (binary file object, backup format suffix)
+    """
+    if backup_path.suffix == '.zst':
+        # Buffered so NDJSON backups can be read line by line
+        f = io.BufferedReader(zstandard.open(backup_path, 'rb'))
+        return f, Path(backup_path.stem).suffix
+    return open(backup_path, 'rb'), backup_path.suffix
+
+
+async def get_target_group(client, group_identifier):
+    """
+    Get the target group, reusing the lookup of an earlier run when possible.
+
+    A group found before is rebuilt from Telethon's session cache, which
+    needs no request to Telegram; its ID and title come from TARGET_CACHE_FILE.
+
+    Args:
+        client: TelegramClient instance
+        group_identifier: Group username (e.g., @groupname), invite link, or group ID
+
+    Returns:
+        Tuple of (group entity or input peer, group ID, group title)
+    """
+    try:
+        cache = orjson.loads(TARGET_CACHE_FILE.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        cache = {}
+
+    cached = cache.get(group_identifier)
+    if cached:
+        try:
+            input_peer = await client.get_input_entity(cached['peer_id'])
+            return input_peer, cached['id'], cached['title']
+        except ValueError:
+            pass  # No longer in the session cache, look the group up again
+
+    group = await get_group_entity(client, group_identifier)
+    cache[group_identifier] = {'peer_id': get_peer_id(group), 'id': group.id, 'title': group.title}
+    try:
+        TARGET_CACHE_FILE.write_bytes(orjson.dumps(cache))
+    except OSError as e:
+        print(f"Warning: Could not save target group cache: {e}")
+    return group, group.id, group.title
+
+
+def load_backup_messages(backup_path):
+    """
+    Load all the messages from a backup file.
+
+    Args:
+        backup_path: Path to the backup file (see open_backup_file)
+
+    Returns:
+        List of message dictionaries
+    """
+    f, backup_format = open_backup_file(backup_path)
+    with f:
+        if backup_format == '.ndjson':
+            records = (orjson.loads(line) for line in f if line.strip())
+            return [record for record in records if not record.get('header')]
+        if backup_path.suffix == '.json':
+            # Parse the file through a memory map, without first copying it into memory
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                data = orjson.loads(view)
+        else:
+            data = orjson.loads(f.read())
+    return data.get('messages', [])
+
+
+def iter_backup_messages(backup_path):
+    """
+    Read the messages from a backup file one at a time.
+
+    Unlike load_backup_messages, the backup is parsed incrementally, so
+    memory use does not grow with the size of the file.
+
+    Args:
+        backup_path: Path to the backup file (see open_backup_file)
+
+    Yields:
+        Message dictionaries, in file order
+    """
+    f, backup_format = open_backup_file(backup_path)
+    with f:
+        if backup_format == '.ndjson':
+            for line in f:
+                if line.strip():
+                    record = orjson.loads(line)
+                    if not record.get('header'):
+                        yield record
+        else:
+            yield from ijson.items(f, 'messages.item', use_float=True)
+
+
+def message_date_key(message_data):
+    """Sort key ordering messages by date, with undated messages first."""
+    return message_data['date'] if message_data.get('date') else ''
+
+
+def sort_by_date(messages):
+    """
+    Sort a list of messages by date in place, with undated messages first.
+
+    Missing dates are normalized to '' in one pass first, so the sort can use
+    a C-level itemgetter key instead of calling message_date_key per message.
+
+    Args:
+        messages: List of message dictionaries
+
+    Returns:
+        The same list, sorted
+    """
+    for message_data in messages:
+        if not message_data.get('date'):
+            message_data['date'] = ''
+    messages.sort(key=operator.itemgetter('date'))
+    return messages
+
+
+def scan_backup_messages(backup_path):
+    """
+    Count the messages in a backup file and check whether they are in date order.
+
+    Args:
+        backup_path: Path to the backup file (see open_backup_file)
+
+    Returns:
+        Tuple of (message count, True if the messages are sorted by date)
+    """
+    count = 0
+    in_order = True
+    previous = ''
+    for message_data in iter_backup_messages(backup_path):
+        count += 1
+        date = message_date_key(message_data)
+        if date < previous:
+            in_order = False
+        previous = date
+    return count, in_order
+
+
+def iter_merged_messages(backup_paths, sorted_paths):
+    """
+    Read the messages from several backup files, merged in date order.
+
+    Backups already in date order are streamed. The others (deleted message
+    backups are written newest first) are loaded and sorted on their own.
+    Messages with the same date keep the order of the backup files.
+
+    Args:
+        backup_paths: Paths to the backup files
+        sorted_paths: Set of the backup paths already sorted by date
+
+    Yields:
+        Message dictionaries, oldest first
+    """
+    sources = []
+    for backup_path in backup_paths:
+        if backup_path in sorted_paths:
+            sources.append(iter_backup_messages(backup_path))
+        else:
+            sources.append(sort_by_date(load_backup_messages(backup_path)))
+    yield from heapq.merge(*sources, key=message_date_key)
+
+
+@functools.lru_cache(maxsize=4096)
+def format_header_details(sender_name, deleted, media_type, forward_name):
+    """
+    Format the part of the message header that follows the timestamp.
+
+    Senders and media types repeat across many messages, so results are cached.
+
+    Args:
+        sender_name: Name of the message author
+        deleted: Whether the message comes from a deleted messages backup
+        media_type: Telethon media class name, or None
+        forward_name: Name of the original author of a forwarded message, or None
+
+    Returns:
+        Formatted header details string
+    """
+    details = f" | 👤 {sender_name}"
+
+    # Add deleted indicator if from deleted messages backup
+    if deleted:
+        details += " | 🗑️ DELETED"
+
+    # Add media indicator if present
+    if media_type:
+        details += f" | 📎 {media_type.replace('MessageMedia', '')}"
+
+    # Add forward indicator if present
+    if forward_name:
+        details += f" | ↩️ Forwarded from: {forward_name}"
+
+    return details
+
+
+def format_message_date(date):
+    """
+    Format an ISO 8601 date from a backup as "YYYY-MM-DD HH:MM:SS".
+
+    Backups store full timestamps ("2024-01-31T12:34:56+00:00"), which are
+    formatted by slicing; anything else is parsed.
+    """
+    if len(date) >= 19 and date[4] == '-' and date[10] in 'T ' and date[16] == ':':
+        return date[:10] + ' ' + date[11:19]
+    return datetime.fromisoformat(date).strftime("%Y-%m-%d %H:%M:%S")
+
+
 def format_message_header(message_data):
     """
-    Format the message header with timestamp and author.
+    Format the message header with timestamp, author and indicators.
 
     Args:
         message_data: Dictionary containing message data
@@ -247,22 +615,21 @@ def format_message_header(message_data):
     Returns:
         Formatted header string
     """
+    get = message_data.get
     date_str = "Unknown date"
-    if message_data.get('date'):
+    if date := get('date'):
         try:
-            date = datetime.fromisoformat(message_data['date'])
-            date_str = date.strftime("%Y-%m-%d %H:%M:%S")
+            date_str = format_message_date(date)
         except:
-            date_str = message_data['date']
-
-    sender_name = message_data.get('sender_name', 'Unknown')
-    header = f"📅 {date_str} | 👤 {sender_name}"
-
-    # Add deleted indicator if from deleted messages backup
-    if message_data.get('deleted_date'):
-        header += " | 🗑️ DELETED"
-
-    return header
+            date_str = date
+
+    forward_info = get('forward_info')
+    return f"📅 {date_str}" + format_header_details(
+        get('sender_name', 'Unknown'),
+        bool(get('deleted_date')),
+        get('media_type'),
+        forward_info.get('from_name') if forward_info else None
+    )
 
 
 def format_message_text(message_data):
@@ -275,45 +642,299 @@ def format_message_text(message_data):
     Returns:
         Formatted message string
     """
-    header = format_message_header(message_data)
-    text = message_data.get('text', '')
+    return f"{format_message_header(message_data)}\n{MESSAGE_SEPARATOR}\n{message_data.get('text') or '[No text content]'}"
 
-    # Add media indicator if present
-    if message_data.get('media_type'):
-        media_type = message_data['media_type'].replace('MessageMedia', '')
-        header += f" | 📎 {media_type}"
 
-    # Add forward indicator if present
-    if message_data.get('forward_info'):
-        forward_info = message_data['forward_info']
-        if forward_info.get('from_name'):
-            header += f" | ↩️ Forwarded from: {forward_info['from_name']}"
+@functools.lru_cache(maxsize=None)
+def list_directory(directory):
+    """
+    List the names in a directory, scanning it only once.
+
+    Media files are looked up in the same few directories over and over,
+    so one scandir per directory replaces a stat call per message.
+
+    Args:
+        directory: Path of the directory
+
+    Returns:
+        Frozen set of the entry names (empty if the directory doesn't exist)
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return frozenset(entry.name for entry in entries)
+    except OSError:
+        return frozenset()
+
+
+def coalesce_kind(message_data, backup_dirs):
+    """
+    Check how a message may be combined with its neighbours.
+
+    Returns:
+        'text' for a text message, 'album' for a photo whose file is in the
+        backup, or None if the message must be sent on its own
+    """
+    if not message_data.get('date') or message_data.get('forward_info'):
+        return None
+    if not message_data.get('media_type'):
+        return 'text' if message_data.get('text') else None
+    if message_data['media_type'] == 'MessageMediaPhoto' and resolve_media_path(message_data, backup_dirs):
+        return 'album'
+    return None
+
+
+def group_messages(messages, backup_dirs):
+    """
+    Group consecutive messages from the same sender to send them together.
+
+    A message joins the current group if both are of the same kind (see
+    coalesce_kind), they have the same sender and come from the same kind
+    of backup, and it was written within COALESCE_WINDOW seconds after the
+    first message of the group (so messages out of date order, such as a
+    newest-first deleted messages backup, are never joined). Text groups stay under MAX_MESSAGE_LENGTH
+    characters, albums under MAX_ALBUM_SIZE photos.
+
+    Args:
+        messages: Iterator over message dictionaries
+        backup_dirs: Directories media paths are resolved against
+
+    Yields:
+        Lists of consecutive message dictionaries
+    """
+    group = []
+    group_kind = None
+    group_start = None
+    length = 0
+    for message_data in messages:
+        timestamp = None
+        kind = coalesce_kind(message_data, backup_dirs)
+        if kind:
+            try:
+                timestamp = datetime.fromisoformat(message_data['date']).timestamp()
+            except ValueError:
+                kind = None
+
+        # Each grouped text message is one line: "[HH:MM:SS] text"
+        line_length = len(message_data.get('text') or '') + 12
+        if (group and kind is not None and kind == group_kind
+                and message_data.get('sender_name') == group[0].get('sender_name')
+                and bool(message_data.get('deleted_date')) == bool(group[0].get('deleted_date'))
+                and 0 <= timestamp - group_start < COALESCE_WINDOW
+                and (len(group) < MAX_ALBUM_SIZE if kind == 'album'
+                     else length + line_length <= MAX_MESSAGE_LENGTH)):
+            group.append(message_data)
+            length += line_length
+            continue
+
+        if group:
+            yield group
+        group = [message_data]
+        group_kind = kind
+        group_start = timestamp
+        length = len(format_message_header(message_data)) + len(MESSAGE_SEPARATOR) + 1 + line_length
+    if group:
+        yield group
+
+
+def format_message_group(group):
+    """
+    Format a group of messages as a single message.
+
+    Args:
+        group: List of message dictionaries from group_messages
+
+    Returns:
+        Formatted message string, or for an album a list with the
+        caption of each photo
+    """
+    if len(group) == 1:
+        return format_message_text(group[0])
+    if group[0].get('media_type'):
+        return [format_message_text(message_data) for message_data in group]
+
+    lines = []
+    for message_data in group:
+        time_str = format_message_date(message_data['date'])[11:]
+        lines.append(f"[{time_str}] {message_data['text']}")
+    return f"{format_message_header(group[0])}\n{MESSAGE_SEPARATOR}\n" + "\n".join(lines)
+
+
+def resolve_media_path(message_data, backup_dirs):
+    """
+    Find the media file of a message in the backup directories.
+
+    Args:
+        message_data: Dictionary containing message data
+        backup_dirs: Directories the media path may be relative to
+
+    Returns:
+        Path to the media file as a string, or None if there is none
+    """
+    if not message_data.get('media_path'):
+        return None
+
+    # Try to resolve media path relative to backup file
+    for backup_dir in backup_dirs:
+        potential_path = backup_dir / message_data['media_path']
+        if potential_path.name in list_directory(potential_path.parent):
+            return str(potential_path)
+    return None
+
+
+def prepare_messages(groups, backup_dirs, count):
+    """
+    Format the next message groups and resolve their media, ready to be sent.
+
+    This only does blocking work (reading backups, formatting, checking
+    files), so it is run on a worker thread to keep the event loop free.
+
+    Args:
+        groups: Iterator over lists of message dictionaries (see group_messages)
+        backup_dirs: Directories media paths are resolved against
+        count: Maximum number of groups to prepare
+
+    Returns:
+        List of (group, message_text, media_path) tuples (for an album,
+        message_text and media_path are lists), empty once the messages
+        are exhausted
+    """
+    prepared = []
+    for group in itertools.islice(groups, count):
+        if len(group) > 1 and group[0].get('media_type'):
+            media_path = [resolve_media_path(message_data, backup_dirs) for message_data in group]
+        else:
+            media_path = resolve_media_path(group[0], backup_dirs)
+        prepared.append((group, format_message_group(group), media_path))
+    return prepared
+
 
-    separator = "-" * 50
-    return f"{header}\n{separator}\n{text}" if text else f"{header}\n{separator}\n[No text content]"
+class RateLimiter:
+    """
+    Sliding-window rate limiter.
+
+    Allows at most `rate` requests in any `per`-second window, so requests
+    go out as soon as the window has room instead of after a fixed delay.
+    """
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._times = collections.deque()
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait until a request fits in the window, then record it."""
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._times and now - self._times[0] >= self.per:
+                    self._times.popleft()
+                if len(self._times) < self.rate:
+                    break
+                # Sleep until the oldest request leaves the window
+                try:
+                    await asyncio.wait_for(self._cond.wait(), self._times[0] + self.per - now)
+                except asyncio.TimeoutError:
+                    pass
+            self._times.append(now)
+            self._cond.notify(1)
+
+
+async def upload_file_parallel(client, media_path):
+    """
+    Upload a file, sending the parts of large files in parallel.
+
+    Telethon uploads one part at a time, waiting for each to be
+    acknowledged; large files instead keep UPLOAD_PART_WORKERS parts in
+    flight. Smaller files are left to Telethon.
+
+    Args:
+        client: TelegramClient instance
+        media_path: Path to the file
+
+    Returns:
+        Uploaded file, to be passed to send_file
+    """
+    size = os.path.getsize(media_path)
+    if size < PARALLEL_UPLOAD_MIN_SIZE:
+        return await client.upload_file(media_path)
+
+    file_id = generate_random_long()
+    part_count = (size + UPLOAD_PART_SIZE - 1) // UPLOAD_PART_SIZE
+    parts = iter(range(part_count))  # Shared by the workers, each takes the next part
+
+    async def upload_parts():
+        with open(media_path, 'rb') as f:
+            for part in parts:
+                f.seek(part * UPLOAD_PART_SIZE)
+                data = f.read(UPLOAD_PART_SIZE)
+                if not await client(SaveBigFilePartRequest(file_id, part, part_count, data)):
+                    raise RuntimeError(f"Telegram rejected part {part} of {media_path}")
+
+    workers = [asyncio.create_task(upload_parts()) for _ in range(min(UPLOAD_PART_WORKERS, part_count))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+    return InputFileBig(file_id, part_count, Path(media_path).name)
 
 
-async def send_message_with_retry(client, target_group, message_text, media_path=None, max_retries=3):
+async def upload_media(client, media_path):
+    """
+    Upload a media file so it can be sent later.
+
+    Attributes are read from the local file, which Telethon can't do for
+    an already uploaded one.
+
+    Args:
+        client: TelegramClient instance
+        media_path: Path to the media file, or list of photo paths for an album
+
+    Returns:
+        Tuple of (uploaded file, attributes, mime type); for an album, a
+        list of uploaded files and no attributes (photos need none)
+    """
+    if isinstance(media_path, list):
+        input_files = await asyncio.gather(*(upload_file_parallel(client, path) for path in media_path))
+        return list(input_files), None, None
+
+    attributes, mime_type = get_attributes(media_path)
+    input_file = await upload_file_parallel(client, media_path)
+    return input_file, attributes, mime_type
+
+
+async def send_message_with_retry(client, target_group, message_text, media_path=None, max_retries=3, upload=None):
     """
     Send a message with automatic retry on rate limiting.
 
     Args:
         client: TelegramClient instance
         target_group: Target group entity
-        message_text: Message text to send
-        media_path: Optional path to media file
+        message_text: Message text to send (captions list for an album)
+        media_path: Optional path to media file (already checked to exist),
+            or list of photo paths to send as an album
         max_retries: Maximum number of retries
+        upload: Optional task already uploading the media file (see upload_media)
 
     Returns:
         True if successful, False otherwise
     """
+    input_file = None
     for attempt in range(max_retries):
         try:
-            if media_path and Path(media_path).exists():
+            if media_path:
+                # Upload the file only once, so retries reuse the uploaded copy;
+                # if an upload started ahead of time failed, retry it here
+                if input_file is None:
+                    pending, upload = upload, None
+                    input_file, attributes, mime_type = await (pending or upload_media(client, media_path))
                 await client.send_file(
                     target_group,
-                    media_path,
-                    caption=message_text
+                    input_file,
+                    caption=message_text,
+                    attributes=attributes,
+                    mime_type=mime_type
                 )
             else:
                 await client.send_message(
@@ -361,34 +982,35 @@ async def restore_messages(backup_files, target_group_identifier, merge=True):
         print("\nYou can get API_ID and API_HASH from https://my.telegram.org")
         return
 
-    # Load all messages from backup files
-    all_messages = []
+    backup_paths = []
     for backup_file in backup_files:
         backup_path = Path(backup_file)
         if not backup_path.exists():
             print(f"⚠️  Warning: Backup file not found: {backup_file}")
             continue
-
-        print(f"Loading messages from: {backup_file}")
-        with open(backup_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            messages = data.get('messages', [])
-            print(f"  Loaded {len(messages)} messages")
-            all_messages.extend(messages)
-
-    if not all_messages:
+        backup_paths.append(backup_path)
+
+    # Messages are streamed from the backup files while sending instead of
+    # being held in memory, so only count them (and check their order) here
+    total_messages = 0
+    sorted_paths = set()
+    for backup_path in backup_paths:
+        print(f"Reading messages from: {backup_path}")
+        count, in_order = scan_backup_messages(backup_path)
+        print(f"  Found {count} messages")
+        total_messages += count
+        if in_order:
+            sorted_paths.add(backup_path)
+
+    if not total_messages:
         print("✗ No messages to restore")
         return
 
-    # Sort messages by date if merging
-    if merge:
-        print(f"\nMerging and sorting {len(all_messages)} messages by date...")
-        all_messages.sort(key=lambda x: x['date'] if x.get('date') else '')
-
-    print(f"\nTotal messages to restore: {len(all_messages)}")
+    print(f"\nTotal messages to restore: {total_messages}")
 
     # Initialize Telegram client
     client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
+    enable_session_wal(client)
 
     try:
         await client.start(phone=PHONE)
@@ -396,8 +1018,8 @@ async def restore_messages(backup_files, target_group_identifier, merge=True):
 
         # Get the target group entity
         print(f"\nGetting target group entity for: {target_group_identifier}")
-        target_group = await get_group_entity(client, target_group_identifier)
-        print(f"Target group found: {target_group.title} (ID: {target_group.id})")
+        target_group, target_group_id, target_group_title = await get_target_group(client, target_group_identifier)
+        print(f"Target group found: {target_group_title} (ID: {target_group_id})")
 
         # === CHECKPOINT HANDLING ===
         start_index = 0
@@ -409,7 +1031,7 @@ async def restore_messages(backup_files, target_group_identifier, merge=True):
 
         if checkpoint:
             is_valid, reason = validate_checkpoint(
-                checkpoint, backup_files, target_group.id, merge
+                checkpoint, backup_files, target_group_id, merge, strict=CHECKPOINT_STRICT
             )
 
             if is_valid:
@@ -444,15 +1066,15 @@ async def restore_messages(backup_files, target_group_identifier, merge=True):
         # Create new checkpoint if needed
         if checkpoint is None:
             checkpoint = create_checkpoint(
-                backup_files, target_group.id, target_group.title,
-                merge, len(all_messages)
+                backup_files, target_group_id, target_group_title,
+                merge, total_messages
             )
             save_checkpoint(checkpoint)
 
         # === CONFIRMATION (only for new restores starting from beginning) ===
         if start_index == 0:
             print("\n" + "=" * 60)
-            print(f"Ready to send {len(all_messages)} messages to: {target_group.title}")
+            print(f"Ready to send {total_messages} messages to: {target_group_title}")
             print("=" * 60)
             confirm = input("\nProceed? (yes/no): ").strip().lower()
 
@@ -464,65 +1086,119 @@ async def restore_messages(backup_files, target_group_identifier, merge=True):
         print("\nRestoring messages...")
         start_time = time.time()
 
-        for idx in range(start_index, len(all_messages)):
-            message_data = all_messages[idx]
-            display_num = idx + 1
-
-            print(f"\nSending message {display_num}/{len(all_messages)} (ID: {message_data.get('message_id', 'unknown')})", end='')
-
-            # Format message
-            message_text = format_message_text(message_data)
-
-            # Get media path (relative to backup directory)
-            media_path = None
-            if message_data.get('media_path'):
-                # Try to resolve media path relative to backup file
-                for backup_file in backup_files:
-                    backup_dir = Path(backup_file).parent
-                    potential_path = backup_dir / message_data['media_path']
-                    if potential_path.exists():
-                        media_path = str(potential_path)
-                        break
-
-            # Send message
-            success = await send_message_with_retry(
-                client,
-                target_group,
-                message_text,
-                media_path
-            )
-
-            if success:
-                success_count += 1
-                print(" ✓")
-            else:
-                failed_count += 1
-                failed_message_ids.append(message_data.get('message_id'))
-                print(" ✗")
-
-            # === UPDATE CHECKPOINT AFTER EACH MESSAGE ===
-            elapsed = prior_elapsed + (time.time() - start_time)
-            checkpoint['last_successful_index'] = idx
-            checkpoint['last_message_id'] = message_data.get('message_id')
-            checkpoint['success_count'] = success_count
-            checkpoint['failed_count'] = failed_count
-            checkpoint['failed_message_ids'] = failed_message_ids
-            checkpoint['elapsed_seconds'] = elapsed
-            save_checkpoint(checkpoint)
+        if merge:
+            print(f"Merging and sorting {total_messages} messages by date...")
+            messages = iter_merged_messages(backup_paths, sorted_paths)
+        else:
+            messages = itertools.chain.from_iterable(map(iter_backup_messages, backup_paths))
+        messages = itertools.islice(messages, start_index, None)
 
-            # Rate limiting delay
-            delay = MEDIA_DELAY if media_path else MESSAGE_DELAY
-            await asyncio.sleep(delay)
+        # Directories media paths are resolved against, one per backup location
+        backup_dirs = list(dict.fromkeys(backup_path.parent for backup_path in backup_paths))
+        if COALESCE_MESSAGES:
+            groups = group_messages(messages, backup_dirs)
+        else:
+            groups = ([message_data] for message_data in messages)
+
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+        async def upload_ahead(media_path):
+            """Upload a media file while the messages before it are being sent."""
+            async with upload_slots:
+                return await upload_media(client, media_path)
+
+        async def prepare():
+            """Prepare messages in batches on a worker thread, ahead of the sender, in order."""
+            idx = start_index
+            try:
+                while batch := await asyncio.to_thread(prepare_messages, groups, backup_dirs, PREPARE_BATCH_SIZE):
+                    for group, message_text, media_path in batch:
+                        upload = asyncio.create_task(upload_ahead(media_path)) if media_path else None
+                        await queue.put((idx, group, message_text, media_path, upload))
+                        idx += len(group)
+            finally:
+                await queue.put(None)
+
+        last_saved_idx = start_index - 1
+        last_checkpoint_time = time.monotonic()
+        producer = asyncio.create_task(prepare())
+        try:
+            # Sender: messages go out one at a time, in order; the next ones are
+            # already prepared, and their media uploaded, while the current one
+            # is being sent
+            limiter = RateLimiter(RATE_LIMIT_MESSAGES, RATE_LIMIT_PERIOD)
+            last_progress = 0.0
+            while (item := await queue.get()) is not None:
+                # idx is the index of the first message of the group, last_idx of the last one
+                idx, group, message_text, media_path, upload = item
+                last_idx = idx + len(group) - 1
+                display_num = last_idx + 1
+                message_id = group[-1].get('message_id', 'unknown')
+
+                # Rate limiting: wait for room in the sliding window
+                await limiter.acquire()
+
+                # Send message
+                success = await send_message_with_retry(
+                    client,
+                    target_group,
+                    message_text,
+                    media_path,
+                    upload=upload
+                )
 
-            # Progress update every 10 messages
-            if display_num % 10 == 0:
-                total_elapsed = prior_elapsed + (time.time() - start_time)
-                messages_sent_this_session = idx - start_index + 1
-                if messages_sent_this_session > 0:
-                    avg_time = (time.time() - start_time) / messages_sent_this_session
-                    remaining = (len(all_messages) - display_num) * avg_time
-                    print(f"  Progress: {display_num}/{len(all_messages)} | Success: {success_count} | Failed: {failed_count}")
-                    print(f"  Estimated time remaining: {int(remaining / 60)}m {int(remaining % 60)}s")
+                if success:
+                    success_count += len(group)
+                else:
+                    failed_count += len(group)
+                    failed_message_ids.extend(message_data.get('message_id') for message_data in group)
+                    print(f"\n✗ Failed to send message {display_num}/{total_messages} (ID: {message_id})")
+
+                # === UPDATE CHECKPOINT AFTER EACH MESSAGE ===
+                # (saved to disk every few messages, and when the loop exits)
+                elapsed = prior_elapsed + (time.time() - start_time)
+                checkpoint['last_successful_index'] = last_idx
+                checkpoint['last_message_id'] = group[-1].get('message_id')
+                checkpoint['success_count'] = success_count
+                checkpoint['failed_count'] = failed_count
+                checkpoint['failed_message_ids'] = failed_message_ids
+                checkpoint['elapsed_seconds'] = elapsed
+                now = time.monotonic()
+                if (last_idx - last_saved_idx >= CHECKPOINT_INTERVAL_MSGS
+                        or now - last_checkpoint_time > CHECKPOINT_INTERVAL_SECS):
+                    save_checkpoint(checkpoint)
+                    last_saved_idx = last_idx
+                    last_checkpoint_time = now
+
+                # Progress update every 10 messages, and a status line in between
+                # (throttled, since terminal output blocks the event loop)
+                if display_num // 10 > idx // 10:
+                    total_elapsed = prior_elapsed + (time.time() - start_time)
+                    messages_sent_this_session = last_idx - start_index + 1
+                    if messages_sent_this_session > 0:
+                        avg_time = (time.time() - start_time) / messages_sent_this_session
+                        remaining = (total_messages - display_num) * avg_time
+                        print(
+                            f"\n  Progress: {display_num}/{total_messages} | Success: {success_count} | Failed: {failed_count}"
+                            f"\n  Estimated time remaining: {int(remaining / 60)}m {int(remaining % 60)}s"
+                        )
+                else:
+                    now = time.monotonic()
+                    if now - last_progress >= PROGRESS_INTERVAL:
+                        print(f"Restored message {display_num}/{total_messages} (ID: {message_id})...", end='\r')
+                        last_progress = now
+
+            await producer
+        finally:
+            producer.cancel()
+            # Save the progress not yet written, also when interrupted
+            if checkpoint['last_successful_index'] != last_saved_idx:
+                save_checkpoint(checkpoint)
+            # Stop the uploads of messages that won't be sent in this run
+            while not queue.empty():
+                if (item := queue.get_nowait()) is not None and item[4] is not None:
+                    item[4].cancel()
 
         # === SUCCESSFUL COMPLETION ===
         clear_checkpoint()
@@ -531,7 +1207,7 @@ async def restore_messages(backup_files, target_group_identifier, merge=True):
         print("\n" + "=" * 60)
         print("Restoration Complete")
         print("=" * 60)
-        print(f"Total messages: {len(all_messages)}")
+        print(f"Total messages: {total_messages}")
         print(f"Successfully sent: {success_count}")
         print(f"Failed: {failed_count}")
         print(f"Time taken: {int(elapsed / 60)}m {int(elapsed % 60)}s")
@@ -597,6 +1273,8 @@ def main():
         merge = merge != 'no'
 
     # Run the async function
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(restore_messages(backup_files, target_group, merge))
 
 
@@ -7,6 +7,7 @@ import asyncio
 import os
 from dotenv import load_dotenv
 from telethon import TelegramClient
+from telethon.tl.types import Chat, Channel
 
 # Load environment variables
 load_dotenv()
@@ -29,29 +30,33 @@ async def list_groups():
         print("Your Groups and Channels:")
         print("=" * 80)
 
+        # Collect the listing and print it at once at the end
+        lines = []
         async for dialog in client.iter_dialogs():
             if dialog.is_group or dialog.is_channel:
-                from telethon.tl.types import Chat, Channel
-
                 # Determine the type
-                if isinstance(dialog.entity, Chat):
+                entity = dialog.entity
+                if isinstance(entity, Chat):
                     group_type = "Regular Chat (no admin log support)"
-                elif isinstance(dialog.entity, Channel):
-                    if dialog.entity.megagroup:
+                elif isinstance(entity, Channel):
+                    if entity.megagroup:
                         group_type = "Supergroup (supports admin log)"
-                    elif dialog.entity.broadcast:
+                    elif entity.broadcast:
                         group_type = "Channel (supports admin log)"
                     else:
                         group_type = "Channel/Group"
                 else:
                     group_type = "Unknown"
 
-                print(f"\nName: {dialog.name}")
-                print(f"ID: {dialog.id}")
-                if hasattr(dialog.entity, 'username') and dialog.entity.username:
-                    print(f"Username: @{dialog.entity.username}")
-                print(f"Type: {group_type}")
-                print("-" * 80)
+                lines.append(f"\nName: {dialog.name}")
+                lines.append(f"ID: {dialog.id}")
+                username = getattr(entity, 'username', None)
+                if username:
+                    lines.append(f"Username: @{username}")
+                lines.append(f"Type: {group_type}")
+                lines.append("-" * 80)
+        if lines:
+            print("\n".join(lines))
 
     finally:
         await client.disconnect()
@@ -9,7 +9,14 @@ echo.
 REM Check if Python is installed
 python --version >nul 2>&1
 if errorlevel 1 (
-    echo X Python is not installed. Please install Python 3.7 or higher.
+    echo X Python is not installed. Please install Python 3.10 or higher.
+    pause
+    exit /b 1
+)
+
+python -c "import sys; sys.exit(sys.version_info < (3, 10))"
+if errorlevel 1 (
+    echo X Your Python version is too old. Please install Python 3.10 or higher.
     pause
     exit /b 1
 )
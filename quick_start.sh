@@ -8,7 +8,12 @@ echo ""
 
 # Check if Python is installed
 if ! command -v python3 &> /dev/null; then
-    echo "❌ Python 3 is not installed. Please install Python 3.7 or higher."
+    echo "❌ Python 3 is not installed. Please install Python 3.10 or higher."
+    exit 1
+fi
+
+if ! python3 -c 'import sys; sys.exit(sys.version_info < (3, 10))'; then
+    echo "❌ Python $(python3 -c 'import platform; print(platform.python_version())') is too old. Please install Python 3.10 or higher."
     exit 1
 fi
 
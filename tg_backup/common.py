@@ -0,0 +1,381 @@
+"""
+Shared configuration and helpers for the backup scripts
+(1_retrieve_deleted_messages.py and 2_backup_current_messages.py).
+"""
+
+import os
+import sqlite3
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+import orjson
+import zstandard
+from dotenv import load_dotenv
+from telethon import TelegramClient
+from telethon.network import ConnectionTcpAbridged
+from telethon.utils import get_extension
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configuration
+API_ID = os.getenv('TELEGRAM_API_ID')  # Get from https://my.telegram.org
+API_HASH = os.getenv('TELEGRAM_API_HASH')  # Get from https://my.telegram.org
+PHONE = os.getenv('TELEGRAM_PHONE')  # Your phone number with country code
+
+# Output configuration
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'json').lower()  # 'json' or 'ndjson' (one message per line)
+COMPRESS_OUTPUT = os.getenv('COMPRESS_OUTPUT', 'no').lower() in ('yes', 'true', '1')  # Write .zst files
+OUTPUT_BUFFER_SIZE = 1 << 18  # 256 KiB write buffer for the output file
+PRETTY_JSON = os.getenv('PRETTY_JSON', 'no').lower() in ('yes', 'true', '1')  # Indent messages
+JSON_OPTIONS = orjson.OPT_INDENT_2 if PRETTY_JSON and OUTPUT_FORMAT == 'json' else 0
+
+# Concurrency configuration: number of media files downloaded in parallel
+# (at least 1; create the semaphore limiting downloads inside the running event loop)
+CONCURRENCY = max(1, int(os.getenv('DOWNLOAD_CONCURRENCY', '8')))
+PROGRESS_INTERVAL = 0.5  # Minimum seconds between progress updates
+
+# Connection configuration
+CONNECTION_RETRIES = 10  # Reconnection attempts before giving up
+
+
+def check_credentials():
+    """
+    Check that the Telegram credentials are configured, printing help if not.
+
+    Returns:
+        True if API_ID, API_HASH and PHONE are all set
+    """
+    if not API_ID or not API_HASH or not PHONE:
+        print("ERROR: Please set the following environment variables:")
+        print("  - TELEGRAM_API_ID")
+        print("  - TELEGRAM_API_HASH")
+        print("  - TELEGRAM_PHONE")
+        print("\nYou can get API_ID and API_HASH from https://my.telegram.org")
+        return False
+    return True
+
+
+def create_client(session_name):
+    """
+    Create a TelegramClient with the shared connection settings.
+
+    Args:
+        session_name: Name of the Telethon session file
+
+    Returns:
+        TelegramClient instance (not yet started)
+    """
+    return TelegramClient(
+        session_name,
+        API_ID,
+        API_HASH,
+        connection=ConnectionTcpAbridged,
+        connection_retries=CONNECTION_RETRIES,
+        auto_reconnect=True
+    )
+
+
+def output_file_path(output_dir, prefix):
+    """
+    Build a timestamped output file path for the configured format.
+
+    Args:
+        output_dir: Directory the output file is written to
+        prefix: File name prefix (e.g., 'current_messages')
+
+    Returns:
+        Path of the output file
+    """
+    return Path(output_dir) / (
+        f'{prefix}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{OUTPUT_FORMAT}'
+        + ('.zst' if COMPRESS_OUTPUT else '')
+    )
+
+
+async def get_group_entity(client, group_identifier):
+    """
+    Get the group entity from username, invite link, or group ID.
+
+    Args:
+        client: TelegramClient instance
+        group_identifier: Group username (e.g., @groupname), invite link, or group ID
+
+    Returns:
+        Group entity
+    """
+    try:
+        # If it looks like a numeric ID, convert to int
+        if isinstance(group_identifier, str) and group_identifier.lstrip('-').isdigit():
+            group_identifier = int(group_identifier)
+            print(f"Converted to integer: {group_identifier}")
+
+        entity = await client.get_entity(group_identifier)
+        return entity
+    except ValueError as e:
+        # If get_entity fails, try searching through dialogs
+        print(f"Direct lookup failed, searching through your groups...")
+        target_id = int(group_identifier) if isinstance(group_identifier, str) and group_identifier.lstrip('-').isdigit() else None
+
+        async for dialog in client.iter_dialogs():
+            if dialog.is_group or dialog.is_channel:
+                if target_id and dialog.id == target_id:
+                    print(f"Found group in dialogs: {dialog.name}")
+                    return dialog.entity
+
+        print(f"Error getting group entity: {e}")
+        print("\nTroubleshooting tips:")
+        print("1. Make sure you're a member of the group")
+        print("2. Try using the group's @username instead of ID")
+        print("3. Run 'python3 list_groups.py' to see all your groups")
+        print("4. Try getting an invite link from the group and use that")
+        raise
+    except Exception as e:
+        print(f"Error getting group entity: {e}")
+        print("\nTroubleshooting tips:")
+        print("1. Make sure you're a member of the group")
+        print("2. Try using the group's @username instead of ID")
+        print("3. Run 'python3 list_groups.py' to see all your groups")
+        raise
+
+
+def media_file_path(message, media_dir):
+    """
+    Build a deterministic path for a message's media file.
+
+    The name is derived from the chat and message IDs (keeping the original
+    file name when there is one), so a file downloaded by an earlier run can
+    be found again without asking Telegram.
+
+    Args:
+        message: Message object with media
+        media_dir: Directory to save media files
+
+    Returns:
+        Path where the media file is stored
+    """
+    prefix = f"{message.chat_id}_{message.id}"
+    if message.file and message.file.name:
+        return Path(media_dir) / f"{prefix}_{Path(message.file.name).name}"
+    # file.ext also knows link-preview photos, for which get_extension returns ''
+    extension = (message.file.ext if message.file else None) or get_extension(message.media)
+    return Path(media_dir) / f"{prefix}{extension}"
+
+
+def media_file_id(message):
+    """
+    Get the ID of a message's photo or document, which changes when the media is replaced.
+
+    Args:
+        message: Message object with media
+
+    Returns:
+        The ID as a string, or None for media without a photo or document
+    """
+    media = message.photo or message.document
+    return str(media.id) if media else None
+
+
+def open_media_cache(cache_file):
+    """
+    Open (or create) the SQLite index of media downloaded by earlier runs.
+
+    Args:
+        cache_file: Path to the SQLite database file
+
+    Returns:
+        sqlite3.Connection to the media cache
+    """
+    conn = sqlite3.connect(cache_file)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA cache_size=-65536')  # 64 MiB
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS media ('
+        'group_id INTEGER, message_id INTEGER, file_id TEXT, path TEXT, '
+        'PRIMARY KEY (group_id, message_id))'
+    )
+    return conn
+
+
+async def download_media(client, message, media_dir, download_semaphore, media_cache=None):
+    """
+    Download media from a message if it exists.
+
+    Media already recorded in the cache is reused without downloading,
+    as long as the file is still on disk and the message media is unchanged.
+    Without a cache, a file already saved under the same name is reused.
+
+    Args:
+        client: TelegramClient instance
+        message: Message object
+        media_dir: Directory to save media files
+        download_semaphore: asyncio.Semaphore limiting concurrent downloads
+        media_cache: Optional sqlite3.Connection from open_media_cache
+
+    Returns:
+        Path to downloaded file or None
+    """
+    if not message.media:
+        return None
+
+    # Skip the download if an earlier run already saved this file
+    target = media_file_path(message, media_dir)
+    file_id = None
+    if media_cache is not None:
+        file_id = media_file_id(message)
+        row = media_cache.execute(
+            'SELECT file_id, path FROM media WHERE group_id = ? AND message_id = ?',
+            (message.chat_id, message.id)
+        ).fetchone()
+        if row and row[0] == file_id and os.path.exists(row[1]):
+            return row[1]
+    elif target.exists():
+        return str(target)
+
+    try:
+        # Download under a temporary name so an interrupted download is never reused
+        partial = target.with_name(f"{target.name}.partial")
+        async with download_semaphore:
+            file_path = await client.download_media(
+                message.media,
+                file=str(partial)
+            )
+        if not file_path:
+            return None
+
+        os.replace(file_path, target)
+        if media_cache is not None:
+            media_cache.execute(
+                'INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)',
+                (message.chat_id, message.id, file_id, str(target))
+            )
+        return str(target)
+    except Exception as e:
+        print(f"Error downloading media for message {message.id}: {e}")
+        return None
+
+
+def get_sender_details(sender):
+    """
+    Get the ID, display name and username of a message sender.
+
+    Args:
+        sender: User or Channel entity
+
+    Returns:
+        Tuple of (sender_id, sender_name, sender_username)
+    """
+    first_name = getattr(sender, 'first_name', None)
+    last_name = getattr(sender, 'last_name', None)
+    title = getattr(sender, 'title', None)
+    sender_name = ' '.join(filter(None, (first_name, last_name))) or title or "Unknown"
+    return sender.id, sender_name, getattr(sender, 'username', None) or None
+
+
+def resolve_sender(message, sender_cache):
+    """
+    Get the sender details of a message, resolving each sender only once.
+
+    Args:
+        message: Message object
+        sender_cache: Dictionary of sender details already resolved, keyed by sender ID
+
+    Returns:
+        Tuple of (sender_id, sender_name, sender_username)
+    """
+    if message.sender_id in sender_cache:
+        return sender_cache[message.sender_id]
+    if message.sender:
+        details = sender_cache[message.sender_id] = get_sender_details(message.sender)
+        return details
+    return None, "Unknown", None
+
+
+def format_forward_info(forward):
+    """
+    Get the forward header of a message as a dictionary.
+
+    Args:
+        forward: Forward object of the message, or None
+
+    Returns:
+        Dictionary with forward details or None
+    """
+    if not forward:
+        return None
+    return {
+        'from_id': getattr(forward.from_id, 'user_id', None),
+        'from_name': forward.from_name,
+        'date': forward.date
+    }
+
+
+def open_output_stream(raw):
+    """
+    Wrap the output file so data is compressed as it is written, if enabled.
+
+    Args:
+        raw: Output file opened in binary mode
+
+    Returns:
+        Context manager yielding the stream to write to
+    """
+    if COMPRESS_OUTPUT:
+        return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(raw, closefd=False)
+    return nullcontext(raw)
+
+
+def write_json_header(f, fields):
+    """
+    Write the opening of the output JSON object, up to the messages array.
+
+    In NDJSON format the fields are written as a header record on the first line.
+
+    Args:
+        f: Output file opened in binary mode
+        fields: Top-level fields written before the messages
+    """
+    if OUTPUT_FORMAT == 'ndjson':
+        f.write(orjson.dumps({'header': True, **fields}, option=orjson.OPT_APPEND_NEWLINE))
+        return
+
+    f.write(b'{\n')
+    for key, value in fields.items():
+        f.write(b'  ' + orjson.dumps(key) + b': ' + orjson.dumps(value) + b',\n')
+    f.write(b'  "messages": [')
+
+
+def write_json_message(f, message_data, first):
+    """
+    Append one message to the messages array of the output JSON object.
+
+    Args:
+        f: Output file opened in binary mode
+        message_data: Dictionary with message data
+        first: Whether this is the first message in the array
+    """
+    if OUTPUT_FORMAT == 'ndjson':
+        f.write(orjson.dumps(message_data, option=orjson.OPT_APPEND_NEWLINE))
+        return
+
+    f.write(b'\n' if first else b',\n')
+    f.write(orjson.dumps(message_data, option=JSON_OPTIONS))
+
+
+def write_json_footer(f, fields):
+    """
+    Close the messages array and the output JSON object.
+
+    NDJSON files have no closing record, so nothing is written in that format.
+
+    Args:
+        f: Output file opened in binary mode
+        fields: Top-level fields written after the messages
+    """
+    if OUTPUT_FORMAT == 'ndjson':
+        return
+
+    f.write(b'\n  ]')
+    for key, value in fields.items():
+        f.write(b',\n  ' + orjson.dumps(key) + b': ' + orjson.dumps(value))
+    f.write(b'\n}\n')